@@ -1,22 +1,20 @@
 import argparse
 import os
-import pickle
 import random
 import time
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
 from distutils.util import strtobool
+from functools import partial
 
 import hyperstate
 import jax
 import jax.numpy as jnp
 import numpy as np
 import optax
-import torch
 from flax.training.train_state import TrainState
-from torch.utils.data.dataloader import DataLoader
 from torch.utils.tensorboard import SummaryWriter
 
-from cleanrlhf.model import GPT, MODELS_PRESET, GPTConfig
+from cleanrlhf.model import GPT, MODELS_PRESET, GPTConfig, param_decay_mask
 
 os.environ[
     "XLA_PYTHON_CLIENT_MEM_FRACTION"
@@ -38,6 +36,8 @@ def parse_args():
         help="the entity (team) of wandb's project")
     parser.add_argument("--model-type", type=str, default="gpt-mini",
         help="the type of model")
+    parser.add_argument("--dtype", type=str, default=None,
+        help="if set, overrides `trainer.dtype` of the config")
     parser.add_argument("--config", type=str, default=None, help="Path to config file")
     parser.add_argument("--hps", nargs="+", help="Override hyperparameter value")
     args = parser.parse_args()
@@ -45,6 +45,11 @@ def parse_args():
     return args
 
 
+# golden ratio multiplier of Knuth's multiplicative (Fibonacci) hashing, see
+# https://en.wikipedia.org/wiki/Hash_function#Fibonacci_hashing
+HASH_MULTIPLIER = np.uint32(0x9E3779B9)
+
+
 @dataclass
 class TrainerConfig:
     batch_size = 64
@@ -52,8 +57,13 @@ class TrainerConfig:
     betas = (0.9, 0.95)
     weight_decay = 0.1  # only applied on matmul weights
     grad_norm_clip = 1.0
-    num_workers = 0
     max_iters = 2000
+    n_jitted_steps = 50  # number of training steps fused into a single jitted call
+    # dtype of the model's activations and matmuls (params and optimizer state stay in float32);
+    # if None, the model config's dtype is kept, which defaults to bfloat16 on GPU / TPU when unset
+    dtype = None
+    eval_samples = 5000  # number of examples per split used to evaluate the model
+    log_every = 100  # number of training steps between two device -> host fetches of the logged values
 
 
 @dataclass
@@ -62,6 +72,10 @@ class Config:
     trainer: TrainerConfig
 
 
+class TrainState(TrainState):
+    key: jax.random.KeyArray  # PRNG key for dropout, split inside the jitted update
+
+
 class SortDataset:
     """
     Dataset for the Sort problem. E.g. for problem length 6:
@@ -72,11 +86,17 @@ class SortDataset:
     where I is "ignore", as the transformer is reading the input sequence
     """
 
-    def __init__(self, split, length=6, num_digits=3):
+    def __init__(self, split, length=6, num_digits=3, rng=None):
         assert split in {"train", "test"}
+        assert num_digits <= 128, "digits are generated as int8"
         self.split = split
         self.length = length
         self.num_digits = num_digits
+        self.rng = np.random.default_rng() if rng is None else rng
+        # base-`num_digits` place values to pack an input sequence into a single integer code
+        self.bases = np.array([num_digits**i % 2**32 for i in range(length)], dtype=np.uint32)
+        # "ignore" targets at the input locations, shared by every example
+        self.ignore_prefix = np.full((length - 1,), -1, dtype=np.int32)
 
     def __len__(self):
         return 10000  # ...
@@ -91,35 +111,65 @@ class SortDataset:
         return self.length * 2 - 1
 
     def __getitem__(self, idx):
-
-        # use rejection sampling to generate an input example from the desired split
-        while True:
-            # generate some random integers
-            inp = torch.randint(self.num_digits, size=(self.length,), dtype=torch.long)
-            # half of the time let's try to boost the number of examples that
-            # have a large number of repeats, as this is what the model seems to struggle
-            # with later in training, and they are kind of rate
-            if torch.rand(1).item() < 0.5:
-                if inp.unique().nelement() > self.length // 2:
-                    # too many unique digits, re-sample
-                    continue
-            # figure out if this generated example is train or test based on its hash
-            h = hash(pickle.dumps(inp.tolist()))
-            inp_split = "test" if h % 4 == 0 else "train"  # designate 25% of examples as test
-            if inp_split == self.split:
-                break  # ok
+        x, y = self.get_batch(1)
+        return x[0], y[0]
+
+    def _reject(self, inp, boost, xp=np):
+        """
+        rejection mask for a batch of inputs of shape (B, length), `xp` is either `numpy` or `jax.numpy`.
+        `boost` is a random (B,) boolean mask: for those rows, let's try to boost the number of examples that
+        have a large number of repeats, as this is what the model seems to struggle
+        with later in training, and they are kind of rate
+        """
+        num_unique = (inp[:, :, None] == xp.arange(self.num_digits)).any(axis=1).sum(axis=1)
+        too_many_unique = boost & (num_unique > self.length // 2)
+        # figure out if this generated example is train or test based on its hash
+        code = (inp.astype(xp.uint32) * self.bases).sum(axis=1, dtype=xp.uint32)
+        h = code * HASH_MULTIPLIER  # wraps around modulo 2**32
+        is_test = h >> 30 == 0  # designate 25% of examples as test
+        return too_many_unique | (is_test != (self.split == "test"))
+
+    def get_batch(self, batch_size):
+        # generate some random integers
+        inp = self.rng.integers(self.num_digits, size=(batch_size, self.length), dtype=np.int8)
+        # use rejection sampling to generate input examples from the desired split,
+        # only re-sampling the rejected rows
+        rejected = self._reject(inp, self.rng.random(batch_size) < 0.5)
+        while rejected.any():
+            inp[rejected] = self.rng.integers(self.num_digits, size=(rejected.sum(), self.length), dtype=np.int8)
+            rejected[rejected] = self._reject(inp[rejected], self.rng.random(rejected.sum()) < 0.5)
 
         # solve the task: i.e. sort
-        sol = torch.sort(inp)[0]
+        sol = np.sort(inp, axis=1)
 
-        # concatenate the problem specification and the solution
-        cat = torch.cat((inp, sol), dim=0)
-
-        # the inputs to the transformer will be the offset sequence
-        x = cat[:-1].clone()
-        y = cat[1:].clone()
+        # x and y are (contiguous) views into a single buffer, filled in place
+        x, y = np.empty((2, batch_size, self.get_block_size()), dtype=np.int32)
+        # the inputs to the transformer will be the offset concatenation of the problem specification and the solution
+        x[:, : self.length] = inp
+        x[:, self.length :] = sol[:, :-1]
         # we only want to predict at output locations, mask out the loss at the input locations
-        y[: self.length - 1] = -1
+        y[:, : self.length - 1] = self.ignore_prefix
+        y[:, self.length - 1 :] = sol
+        return x, y
+
+    def get_device_batch(self, key, batch_size):
+        """same as `get_batch`, but in pure JAX so that it can generate the batch on the device inside a jitted function"""
+        key, inp_key, boost_key = jax.random.split(key, 3)
+        inp = jax.random.randint(inp_key, (batch_size, self.length), 0, self.num_digits)
+        rejected = self._reject(inp, jax.random.uniform(boost_key, (batch_size,)) < 0.5, xp=jnp)
+
+        def body_fn(val):
+            key, inp, rejected = val
+            key, inp_key, boost_key = jax.random.split(key, 3)
+            new_inp = jax.random.randint(inp_key, (batch_size, self.length), 0, self.num_digits)
+            inp = jnp.where(rejected[:, None], new_inp, inp)
+            rejected = rejected & self._reject(inp, jax.random.uniform(boost_key, (batch_size,)) < 0.5, xp=jnp)
+            return key, inp, rejected
+
+        _, inp, _ = jax.lax.while_loop(lambda val: val[2].any(), body_fn, (key, inp, rejected))
+        sol = jnp.sort(inp, axis=1)
+        x = jnp.concatenate((inp, sol[:, :-1]), axis=1)
+        y = jnp.concatenate((jnp.broadcast_to(self.ignore_prefix, (batch_size, self.length - 1)), sol), axis=1)
         return x, y
 
 
@@ -130,7 +180,16 @@ if __name__ == "__main__":
     if args.model_type:
         assert args.model_type in MODELS_PRESET, f"model_type {args.model_type} not found in {MODELS_PRESET.keys()}"
         gpt_config = MODELS_PRESET[args.model_type]
+    if args.dtype is not None:
+        config.trainer.dtype = args.dtype
+    if config.trainer.dtype is not None:
+        gpt_config = replace(gpt_config, dtype=config.trainer.dtype)
+    elif gpt_config.dtype is None and jax.default_backend() in ("gpu", "tpu"):
+        gpt_config = replace(gpt_config, dtype="bfloat16")  # bfloat16 is slower than float32 on CPU
     config.gpt = gpt_config
+    assert (
+        config.trainer.max_iters % config.trainer.n_jitted_steps == 0
+    ), f"max_iters {config.trainer.max_iters} must be a multiple of n_jitted_steps {config.trainer.n_jitted_steps}"
     print(config)
     run_name = f"{args.exp_name}__{args.seed}__{int(time.time())}"
     if args.track:
@@ -154,16 +213,22 @@ if __name__ == "__main__":
     random.seed(args.seed)
     np.random.seed(args.seed)
     key = jax.random.PRNGKey(args.seed)
-    key, params_key, actor_key, critic_key = jax.random.split(key, 4)
+    key, params_key, dropout_key = jax.random.split(key, 3)
 
     # set up dataset
-    train_dataset = SortDataset("train")
-    test_dataset = SortDataset("test")
+    rng = np.random.default_rng(args.seed)
+    train_dataset = SortDataset("train", rng=rng)
+    test_dataset = SortDataset("test", rng=rng)
     x, y = train_dataset[0]
     for a, b in zip(x, y):
         print(int(a), int(b))
     vocab_size = train_dataset.get_vocab_size()
     block_size = train_dataset.get_block_size()
+    # materialize a fixed set of evaluation examples per split once, and keep it on the device
+    eval_data = {
+        "train": jax.device_put(train_dataset.get_batch(config.trainer.eval_samples)),
+        "test": jax.device_put(test_dataset.get_batch(config.trainer.eval_samples)),
+    }
 
     # initialize model
     gpt = GPT(
@@ -181,111 +246,134 @@ if __name__ == "__main__":
         params=gpt_params,
         tx=optax.chain(
             optax.clip_by_global_norm(config.trainer.grad_norm_clip),
-            optax.inject_hyperparams(optax.adamw)(
+            optax.adamw(
                 config.trainer.learning_rate,
                 b1=config.trainer.betas[0],
                 b2=config.trainer.betas[1],
+                weight_decay=config.trainer.weight_decay,
+                mask=param_decay_mask(gpt_params),
             ),
         ),
-    )
-
-    # setup the dataloader
-    train_loader = DataLoader(
-        train_dataset,
-        sampler=torch.utils.data.RandomSampler(train_dataset, replacement=True, num_samples=int(1e10)),
-        shuffle=False,
-        # pin_memory=True,
-        batch_size=config.trainer.batch_size,
-        num_workers=config.trainer.num_workers,
+        key=dropout_key,
     )
 
     # setup the training loop
     iter_num = 0
-    iter_time = 0.0
-    iter_dt = 0.0
-    data_iter = iter(train_loader)
 
-    @jax.jit
-    def update(train_state: TrainState, x, y, key):
-        dropout_key = jax.random.fold_in(key, train_state.step)
+    def update(train_state: TrainState, x, y):
+        key, dropout_key = jax.random.split(train_state.key)
         (loss, logits), grads = jax.value_and_grad(train_state.apply_fn, has_aux=True)(
             train_state.params, x, y, deterministic=False, rngs={"dropout": dropout_key}
         )
-        train_state = train_state.apply_gradients(grads=grads)
+        train_state = train_state.apply_gradients(grads=grads, key=key)
         return train_state, (loss, logits)
 
-    def generate(train_state, key, input_tokens, max_new_tokens, temperature=1.0, top_k=None):
+    n_jitted_steps, batch_size = config.trainer.n_jitted_steps, config.trainer.batch_size
+
+    @partial(jax.jit, donate_argnums=(0,))  # reuse the params and optimizer state buffers in place
+    def multi_step_update(train_state: TrainState):
+        """runs `n_jitted_steps` of `update`, generating each training batch on the device"""
+
+        def scan_f(train_state, _):
+            key, data_key = jax.random.split(train_state.key)
+            x, y = train_dataset.get_device_batch(data_key, batch_size)
+            train_state, (loss, _) = update(train_state.replace(key=key), x, y)
+            return train_state, loss
+
+        train_state, losses = jax.lax.scan(scan_f, train_state, None, length=n_jitted_steps)
+        return train_state, losses
+
+    @partial(jax.jit, static_argnames=("max_new_tokens", "top_k", "do_sample"))
+    def generate(train_state, key, input_tokens, max_new_tokens, temperature=1.0, top_k=None, do_sample=True):
         B, T = input_tokens.shape
-        padding = jnp.zeros((B, max(block_size - T, max_new_tokens)), dtype=jnp.int32)
-        tokens = jnp.concatenate([input_tokens, padding], axis=-1)
-        indexes = jnp.arange(T, T + max_new_tokens)
-        start_indexes = (indexes - block_size).clip(min=0)
-        # print("B, T, max_new_tokens, tokens", B, T, max_new_tokens, tokens.shape)
-        # tokens index -> tokens None
-        def scan_f(tokens, item):
-            (i, start_i) = item
+        # `block_size` is a static python int: the whole decode fits in the context window,
+        # so the context never has to be cropped (and XLA does not need any branch for it)
+        assert T + max_new_tokens - 1 <= block_size, f"cannot generate past the block size {block_size}"
+        # fixed-size token buffer holding the prompt, filled in place while decoding
+        tokens = jnp.zeros((B, max(block_size, T + max_new_tokens)), dtype=jnp.int32).at[:, :T].set(input_tokens)
+
+        def body_fn(i, val):
+            tokens, key = val
             # l: x y
             # t: a b - -
             # i: 0 1 2 3
-            step_key = jax.random.fold_in(key, i)
-            # if the sequence context is growing too long we must crop it at block_size
-            # idx_cond = idx if idx.size(1) <= self.config.block_size else idx[:, -self.config.block_size:]
+            key, step_key = jax.random.split(key)
             # forward the model to get the logits for the index in the sequence
             logits = train_state.apply_fn(
                 train_state.params,
-                jax.lax.dynamic_slice(tokens, (0, start_i), (B, block_size)),
+                tokens[:, :block_size],
                 targets=None,
                 deterministic=False,
                 rngs={"dropout": step_key},
-            )  # TODO: (0, 0) is going to be problematic
+            )
             # pluck the logits at the final step and scale by desired temperature
-            logits = logits[:, i - 1, :] / temperature
+            logits = jax.lax.dynamic_index_in_dim(logits, i - 1, axis=1, keepdims=False) / temperature
             # optionally crop the logits to only the top k options
-            # sample from the distribution
             if top_k is not None:
-                top_logits, top_tokens = jax.lax.top_k(logits, min(top_k, logits.shape[-1]))
-                token_idx = jax.random.categorical(step_key, top_logits, axis=-1)
-                next_token = jnp.take_along_axis(top_tokens, token_idx[:, None], axis=-1).squeeze(-1)
-            else:
+                v, _ = jax.lax.top_k(logits, min(top_k, logits.shape[-1]))
+                logits = jnp.where(logits < v[:, -1:], -jnp.inf, logits)
+            if do_sample:
+                # sample from the distribution
                 next_token = jax.random.categorical(step_key, logits, axis=-1)
-                # logits = jnp.where(logits < v[:, -1:], float('-inf'), logits)
+            else:
+                # take the most likely element
+                next_token = jnp.argmax(logits, axis=-1)
             # append sampled index to the running sequence and continue
-            tokens = tokens.at[:, i].set(next_token)
-
-            return tokens, None
+            tokens = jax.lax.dynamic_update_index_in_dim(tokens, next_token, i, axis=1)
+            return tokens, key
 
-        tokens, _ = jax.lax.scan(scan_f, tokens, (indexes, start_indexes))
+        tokens, _ = jax.lax.fori_loop(T, T + max_new_tokens, body_fn, (tokens, key))
 
         return tokens
 
+    # compile ahead of time, so that tracing and compilation stay out of the training loop and evaluation;
+    # the shapes never change as the batch size and the evaluation set are fixed
+    n = train_dataset.length  # naugy direct access shrug
+    multi_step_update = multi_step_update.lower(train_state).compile()
+    eval_generate = generate.lower(
+        train_state, key, eval_data["train"][0][:, :n], max_new_tokens=n, do_sample=False
+    ).compile()  # using greedy argmax, not sampling
+
+    # losses are kept on the device and only fetched once per logging window,
+    # so that the host does not block on every training step
+    pending_losses = []
+
+    def flush_losses(n_in_flight=0):
+        """fetches and logs the pending losses, except for the newest `n_in_flight` ones which stay on the device"""
+        n_flush = len(pending_losses) - n_in_flight
+        fetched_losses = jax.device_get(pending_losses[:n_flush])  # blocks until these steps are done
+        for log_iter_num, losses in fetched_losses:
+            for i, loss in enumerate(losses):
+                writer.add_scalar("train/loss", loss.item(), log_iter_num + i)
+        del pending_losses[:n_flush]
+        return fetched_losses
+
+    # only `flush_losses` waits for the device, so the time per step is measured between two flushes
+    iter_time = time.time()
+    timed_iter_num = iter_num
     while True:
-        # fetch the next batch (x, y) and re-init iterator if needed
-        try:
-            batch = next(data_iter)
-        except StopIteration:
-            data_iter = iter(train_loader)
-            batch = next(data_iter)
-        batch = [np.array(t) for t in batch]
-        x, y = batch
-        # raise
-
-        train_state, (loss, logits) = update(train_state, x, y, key)
-
-        writer.add_scalar("train/loss", loss.item(), iter_num)
-        writer.add_scalar("charts/learning_rate", train_state.opt_state[1].hyperparams["learning_rate"].item(), iter_num)
-        if iter_num % 100 == 0:
-            print(f"iter_dt {iter_dt * 1000:.2f}ms; iter {iter_num}: train loss {loss.item():.5f}")
-
-        iter_num += 1
-        tnow = time.time()
-        iter_dt = tnow - iter_time
-        iter_time = tnow
+        train_state, losses = multi_step_update(train_state)
+        pending_losses.append((iter_num, losses))
+
+        if iter_num % config.trainer.log_every < n_jitted_steps:
+            # keep the call that was just dispatched in flight, so the device never runs out of work
+            fetched_losses = flush_losses(n_in_flight=1)
+            if fetched_losses:
+                log_iter_num, losses = fetched_losses[-1]
+                last_iter_num = log_iter_num + len(losses) - 1
+                tnow = time.time()
+                iter_dt = (tnow - iter_time) / (last_iter_num + 1 - timed_iter_num)
+                iter_time, timed_iter_num = tnow, last_iter_num + 1
+                writer.add_scalar("charts/learning_rate", config.trainer.learning_rate, iter_num)
+                print(f"iter_dt {iter_dt * 1000:.2f}ms; iter {last_iter_num}: train loss {losses[-1].item():.5f}")
+
+        iter_num += n_jitted_steps
 
         # termination conditions
         if iter_num >= config.trainer.max_iters:
+            flush_losses()
             break
 
-    n = train_dataset.length  # naugy direct access shrug
     inp = jnp.array([[0, 0, 2, 1, 0, 1]], dtype=jnp.int32)
     cat = generate(train_state, key, inp, n)
     sol = jnp.sort(inp)
@@ -295,34 +383,25 @@ if __name__ == "__main__":
     print("gt sort         :", sol)
     print("matches         :", bool((sol == sol_candidate).all()))
 
-    def eval_split(split, max_batches, key):
-        dataset = {"train": train_dataset, "test": test_dataset}[split]
+    def eval_split(split, key):
+        x, y = eval_data[split]
         n = train_dataset.length  # naugy direct access shrug
-        results = []
-        mistakes_printed_already = 0
-        loader = DataLoader(dataset, batch_size=100, num_workers=0, drop_last=False)
-        for b, (x, y) in enumerate(loader):
-            # isolate the input pattern alone
-            x, y = np.array(x), np.array(y)
-            inp = x[:, :n]
-            sol = y[:, -n:]
-            key, subkey = jax.random.split(key, 2)
-            # let the model sample the rest of the sequence
-            cat = generate(train_state, subkey, inp, n, top_k=1)  # using greedy argmax, not sampling
-            sol_candidate = cat[:, n:]  # isolate the filled in sequence
-            # compare the predicted sequence to the true sequence
-            correct = (sol == sol_candidate).all(1)  # Software 1.0 vs. Software 2.0 fight RIGHT on this line haha
-            for i in range(len(x)):
-                results.append(int(correct[i]))
-                if not correct[i] and mistakes_printed_already < 3:  # only print up to 5 mistakes to get a sense
-                    mistakes_printed_already += 1
-                    print(f"GPT claims that {inp[i]} sorted is {sol_candidate[i]} but gt is {sol[i]}")
-            if max_batches is not None and b + 1 >= max_batches:
-                break
-        rt = jnp.array(results, dtype=jnp.float32)
-        print("%s final score: %d/%d = %.2f%% correct" % (split, rt.sum(), len(results), 100 * rt.mean()))
-        return rt.sum()
+        # isolate the input pattern alone
+        inp = x[:, :n]
+        sol = y[:, -n:]
+        # let the model fill in the rest of the sequence for all examples in a single (precompiled) call
+        cat = eval_generate(train_state, key, inp)
+        sol_candidate = cat[:, n:]  # isolate the filled in sequence
+        # compare the predicted sequence to the true sequence
+        correct = jnp.all(sol == sol_candidate, axis=1)  # Software 1.0 vs. Software 2.0 fight RIGHT on this line haha
+        correct = jax.device_get(correct)
+        mistakes = np.flatnonzero(~correct)[:3]  # only print up to 3 mistakes to get a sense
+        inp, sol, sol_candidate = jax.device_get((inp[mistakes], sol[mistakes], sol_candidate[mistakes]))
+        for i in range(len(mistakes)):
+            print(f"GPT claims that {inp[i]} sorted is {sol_candidate[i]} but gt is {sol[i]}")
+        print("%s final score: %d/%d = %.2f%% correct" % (split, correct.sum(), len(correct), 100 * correct.mean()))
+        return correct.sum()
 
     # run a lot of examples from both train and test through the model and verify the output correctness
-    train_score = eval_split("train", max_batches=50, key=key)
-    test_score = eval_split("test", max_batches=50, key=key)
+    train_score = eval_split("train", key=key)
+    test_score = eval_split("test", key=key)